@@ -5,15 +5,63 @@
 """
 
 import os
-import json
+import heapq
+import itertools
+import operator
 import logging
+import shutil
+import signal
 import subprocess
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from html import escape
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote
 
-# set env debug level
-level = os.environ.get('DEBUG', 'INFO')
+from rapidfuzz import fuzz, process, utils
+
+try:
+    # optional, orjson encodes and decodes faster and dumps straight to bytes
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+try:
+    # optional, process.cdist needs it to score large bookmark collections on all cores
+    import numpy as np
+except ImportError:
+    np = None
+
+# set env debug level, the per request logs are info and debug
+level = os.environ.get('DEBUG', 'WARNING')
 logging.basicConfig(filename='server.log', level=level)
 
+# most results returned by a search, same as `bookmarks suggest`
+SEARCH_LIMIT = 20
+# lowest fuzzy score (0-100) of a search result
+SCORE_CUTOFF = 60
+# queries shorter or longer than these get no results
+MIN_QUERY_LENGTH = 2
+MAX_QUERY_LENGTH = 256
+# most queries in one /search_multi request
+MAX_BATCH_SIZE = 32
+# larger POST bodies are not read, a bookmark or a batch of queries is far smaller
+MAX_BODY_SIZE = 1_000_000
+
+# directory where the bookmark files are stored, same default as the bookmarks script
+BOOKMARKS_DIR = os.environ.get('BOOKMARKS_DIR', os.path.expanduser('~/Documents/bookmarks/data'))
+# the bookmarks script next to this file, resolved once at startup
+BOOKMARKS_BIN = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bookmarks')
+
 PAGE_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -30,109 +78,568 @@ PAGE_TEMPLATE = """
   </body>
 </html>
 """;
+# the page around the results, encoded once instead of formatting the template for every response
+PAGE_PREFIX, PAGE_SUFFIX = (part.encode('utf-8') for part in PAGE_TEMPLATE.split('{}'))
+# one result in the html list, filled with % formatting for every bookmark
+ITEM_TEMPLATE = '<li><a href="%s">%s</a></li>'
+
+
+class Bookmarks:
+    """
+        In-memory copy of the bookmarks directory, fuzzy searched in-process
+        instead of running `bookmarks suggest` for every query
+    """
+    # number of queries to keep the results for, the ones searched again are protected
+    # from eviction by the stream of one-off queries typed in between
+    cache_size = 256
+    protected_cache_size = 192
+    # number of recent queries to keep the candidates for
+    candidate_cache_size = 128
+    # score the candidates on all cores with process.cdist when there are more than this
+    parallel_threshold = 1000
+    # seconds between checks of the bookmark file mtimes, the directories are checked on every search
+    check_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        # requests are handled in separate threads, guards the reloads and the cache
+        self.lock = threading.Lock()
+        # segmented LRU of search results, new queries go to the probation segment
+        # and move to the protected segment when they are searched again
+        self.cache = OrderedDict()
+        self.protected_cache = OrderedDict()
+        # mtime and parsed bookmark files of each directory. The files are keyed by filename and
+        # hold their mtime, bookmark, normalized title and uri, so only the changed files are read again
+        self.directories = {}
+        # last time the bookmark file mtimes were checked
+        self.checked = 0.0
+        # changed bookmarks are reloaded in the background, one reload at a time
+        self.reloader = ThreadPoolExecutor(max_workers=1)
+        self.reloading = None
+        # bumped on every update, so a slower background reload does not replace newer bookmarks
+        self.generation = 0
+        self.bookmarks = []
+        self.norm_titles = []
+        self.norm_urls = []
+        self.haystacks = []
+        # candidates of recent queries, to filter instead of all the bookmarks when a query is extended
+        self.candidate_cache = OrderedDict()
+
+    def ensure_fresh(self):
+        """
+            Reload the bookmarks if any directory in the tree has changed, must hold the lock.
+            Searches keep using the current bookmarks while they are reloaded in the background
+        """
+        if not self.directories:
+            self.load()
+        elif self.reloading is None and self.changed():
+            self.reloading = self.reloader.submit(self.reload)
+
+    def changed(self):
+        """
+            Check the directory mtimes, adding or removing a bookmark updates them.
+            A bookmark edited in place only updates its own mtime, so the files are checked too
+        """
+        for directory, (mtime, _) in self.directories.items():
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+
+        # there can be thousands of files, so they are not checked on every keystroke
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return False
+        self.checked = now
+        for _, files in self.directories.values():
+            for filename, (mtime, _, _, _) in files.items():
+                try:
+                    if os.stat(filename).st_mtime != mtime:
+                        return True
+                except FileNotFoundError:
+                    return True
+        return False
+
+    def load(self):
+        """
+            Read all the bookmark files from the bookmarks directory
+        """
+        self.update(self.read())
+
+    def reload(self):
+        """
+            Read the bookmark files in the background, then swap them in
+        """
+        generation = self.generation
+        try:
+            directories = self.read()
+            with self.lock:
+                if generation == self.generation:
+                    self.update(directories)
+        except OSError:
+            logging.exception('Error reloading bookmarks from %s', self.path)
+        finally:
+            # always let ensure_fresh submit the next reload, even after an unexpected error
+            with self.lock:
+                self.reloading = None
+
+    def invalidate(self):
+        """
+            Drop the cached results and reload the changed bookmarks right away,
+            so the next search finds a bookmark that was just added
+        """
+        with self.lock:
+            self.load()
+
+    def read(self):
+        """
+            Read the bookmarks directory tree, only rereading the changed files
+        """
+        directories = {}
+        for directory, dirnames, filenames in os.walk(self.path):
+            # skip hidden directories like .git, same as fd did for `bookmarks suggest`
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+            mtime = os.stat(directory).st_mtime
+            previous = self.directories.get(directory)
+            # the files are checked even when the directory mtime is unchanged, editing one in place leaves it alone
+            directories[directory] = (mtime, self.read_directory(directory, filenames, previous[1] if previous else {}))
+        return directories
+
+    def update(self, directories):
+        """
+            Use the bookmarks read from the directories
+        """
+        files = [file for _, files in directories.values() for file in files.values()]
+        self.generation += 1
+        self.directories = directories
+        self.bookmarks = [bookmark for _, bookmark, _, _ in files]
+        # scoring only walks these parallel lists of normalized strings, the bookmark dicts are
+        # looked up by index for the results. The queries are normalized the same way
+        self.norm_titles = [title for _, _, title, _ in files]
+        self.norm_urls = [url for _, _, _, url in files]
+        self.haystacks = [title + ' ' + url for title, url in zip(self.norm_titles, self.norm_urls)]
+        self.candidate_cache.clear()
+        self.cache.clear()
+        self.protected_cache.clear()
+        logging.info('Loaded %s bookmarks from %s', len(self.bookmarks), self.path)
+
+    def read_directory(self, directory, filenames, previous):
+        """
+            Read the bookmark files of a directory, reusing the previous ones that did not change
+        """
+        category = os.path.relpath(directory, self.path)
+        if category == '.':
+            category = ''
+
+        files = {}
+        for filename in sorted(filenames):
+            if filename.startswith('.') or not filename.endswith('.md'):
+                continue
+            filename = os.path.join(directory, filename)
+            try:
+                mtime = os.stat(filename).st_mtime
+                cached = previous.get(filename)
+                if cached is None or cached[0] != mtime:
+                    bookmark = read_bookmark(filename, category)
+                    cached = (mtime, bookmark, utils.default_process(bookmark['title']), utils.default_process(bookmark['url']))
+            except FileNotFoundError:
+                continue
+            files[filename] = cached
+        return files
+
+    def search(self, query, limit=SEARCH_LIMIT, score_cutoff=SCORE_CUTOFF):
+        """
+            Fuzzy search the bookmarks by title and url
+        """
+        return self.cached_search(query, limit, score_cutoff)[0]
+
+    def search_json(self, query, limit=SEARCH_LIMIT, score_cutoff=SCORE_CUTOFF):
+        """
+            Same as search, but returns the results encoded as JSON, which is cached along with them
+        """
+        entry = self.cached_search(query, limit, score_cutoff)
+        if entry[1] is None:
+            entry[1] = json_dumps(entry[0])
+        return entry[1]
+
+    def cached_search(self, query, limit, score_cutoff):
+        """
+            The cache entry of a search, a list holding the results and their JSON encoding once needed
+        """
+        # cleared or overly long queries are answered without touching the bookmarks
+        if len(query) > MAX_QUERY_LENGTH:
+            return [(), b'[]']
+        query = utils.default_process(query)
+        if len(query) < MIN_QUERY_LENGTH:
+            return [(), b'[]']
+
+        key = (query, limit, score_cutoff)
+        with self.lock:
+            self.ensure_fresh()
+            if key in self.protected_cache:
+                self.protected_cache.move_to_end(key)
+                return self.protected_cache[key]
+
+            entry = self.cache.pop(key, None)
+            if entry is not None:
+                # second hit, the least recently used protected entry goes back on probation
+                self.protected_cache[key] = entry
+                if len(self.protected_cache) > self.protected_cache_size:
+                    demoted_key, demoted = self.protected_cache.popitem(last=False)
+                    self.cache[demoted_key] = demoted
+                return entry
+
+            entry = [self.fuzzy_search(query, limit, score_cutoff), None]
+            self.cache[key] = entry
+            while len(self.cache) + len(self.protected_cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return entry
+
+    def fuzzy_search(self, query, limit, score_cutoff):
+        """
+            Score the query against all the titles and urls.
+            Returns a tuple, the results are cached and shared between requests
+        """
+        # fuzzy scores are meaningless for very short queries, look for a plain substring instead
+        if len(query) < 3:
+            matches = (i for i in range(len(self.bookmarks)) if query in self.norm_titles[i] or query in self.norm_urls[i])
+            return tuple(self.bookmarks[index] for index in itertools.islice(matches, limit))
+
+        candidates = self.candidates(query)
+        if np is not None and len(candidates) > self.parallel_threshold:
+            ranked = self.rank_parallel(query, candidates, limit, score_cutoff)
+        else:
+            ranked = self.rank(query, candidates, limit, score_cutoff)
+        return tuple(self.bookmarks[index] for index in ranked)
+
+    def rank(self, query, candidates, limit, score_cutoff):
+        """
+            Indexes of the best scoring candidates, best first
+        """
+        scores = {}
+        for choices in (self.norm_titles, self.norm_urls):
+            choices = {index: choices[index] for index in candidates}
+            matches = process.extract(query, choices, scorer=fuzz.WRatio, processor=None, limit=limit, score_cutoff=score_cutoff)
+            for _, score, index in matches:
+                scores[index] = max(score, scores.get(index, 0))
+
+        ranked = heapq.nlargest(limit, scores.items(), key=operator.itemgetter(1))
+        return [index for index, _ in ranked]
+
+    def rank_parallel(self, query, candidates, limit, score_cutoff):
+        """
+            Same as rank, but scores all the candidates in one process.cdist call per field,
+            which releases the GIL and uses all the cores
+        """
+        scores = None
+        for choices in (self.norm_titles, self.norm_urls):
+            choices = [choices[index] for index in candidates]
+            matrix = process.cdist([query], choices, scorer=fuzz.WRatio, processor=None, score_cutoff=score_cutoff, workers=-1)
+            scores = matrix[0] if scores is None else np.maximum(scores, matrix[0])
+
+        top = np.argpartition(scores, -limit)[-limit:] if len(scores) > limit else np.arange(len(scores))
+        top = top[np.argsort(scores[top])[::-1]]
+        # cdist sets the scores below score_cutoff to 0
+        return [candidates[i] for i in top if scores[i] > 0]
+
+    def candidates(self, query):
+        """
+            Indexes of the bookmarks containing all the query characters in order, like fzf.
+            A bookmark matching the query matches all its prefixes too, so while typing
+            only the candidates of the longest cached prefix need to be filtered
+        """
+        indexes = range(len(self.haystacks))
+        for end in range(len(query), 0, -1):
+            prefix = query[:end]
+            if prefix in self.candidate_cache:
+                self.candidate_cache.move_to_end(prefix)
+                indexes = self.candidate_cache[prefix]
+                if prefix == query:
+                    return indexes
+                break
+
+        needle = query.replace(' ', '')
+        candidates = [index for index in indexes if is_subsequence(needle, self.haystacks[index])]
+        # filtering more than half of the bookmarks saves little, not worth the memory
+        if len(candidates) <= len(self.haystacks) // 2:
+            self.candidate_cache[query] = candidates
+            if len(self.candidate_cache) > self.candidate_cache_size:
+                self.candidate_cache.popitem(last=False)
+        return candidates
+
+
+def is_subsequence(needle, haystack):
+    """
+        Check if all the characters of needle appear in haystack in the same order
+    """
+    # str.find scans in C, the python loop only runs once per needle character
+    find = haystack.find
+    position = 0
+    for char in needle:
+        position = find(char, position)
+        if position < 0:
+            return False
+        position += 1
+    return True
+
+
+def read_bookmark(filename, category):
+    """
+        Read the title, uri and tags from the front matter of a bookmark file
+    """
+    bookmark = {'url': '', 'title': '', 'tags': [], 'category': category}
+    with open(filename, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('title: ') and not bookmark['title']:
+                bookmark['title'] = line[len('title: '):]
+            elif line.startswith('uri: ') and not bookmark['url']:
+                bookmark['url'] = line[len('uri: '):]
+            elif line.startswith('tags: ') and not bookmark['tags']:
+                tags = line[len('tags: '):].strip('[]')
+                bookmark['tags'] = [tag.strip() for tag in tags.split(',') if tag.strip()]
+    return bookmark
+
+
+class Worker:
+    """
+        Long running `bookmarks worker` process, so the bookmarks script is
+        started once instead of once per request
+    """
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+            Start the worker process
+        """
+        if shutil.which(self.command) is None:
+            logging.error('Bookmarks command not found: %s', self.command)
+            return
+        self.proc = subprocess.Popen([self.command, 'worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def call(self, *args):
+        """
+            Run a bookmarks command in the worker, return the exit code and the output lines.
+            The worker is started again if it has exited
+        """
+        # the arguments are NUL terminated, one containing a NUL would be read as several
+        # arguments and the rest of it as the next command
+        if any('\0' in arg for arg in args):
+            raise ValueError('Worker arguments cannot contain NUL characters')
+        request = b''.join(arg.encode('utf-8') + b'\0' for arg in (str(len(args)),) + args)
+        output = []
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            if self.proc is None:
+                return 1, ['Bookmarks command not found']
+
+            try:
+                self.proc.stdin.write(request)
+                self.proc.stdin.flush()
+            except BrokenPipeError:
+                pass
+            for line in self.proc.stdout:
+                # the reply ends with a NUL character followed by the exit code
+                if line.startswith(b'\0'):
+                    return int(line[1:]), output
+                line = line.decode('utf-8', 'replace').rstrip('\n')
+                if line:
+                    output.append(line)
+
+            # make sure the next call sees the worker as exited and starts a new one
+            self.proc.kill()
+            self.proc.wait()
+
+        logging.error('Bookmarks worker exited')
+        return 1, output + ['Bookmarks worker exited']
+
+    def stop(self):
+        """
+            Stop the worker, it exits when its stdin is closed
+        """
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
 
 
 class Server:
-    def __init__(self, port):
+    def __init__(self, port, bookmarks_dir):
         self.port = port
+        self.bookmarks = Bookmarks(bookmarks_dir)
+        self.worker = Worker(BOOKMARKS_BIN)
 
     def run(self):
         """
             Run the server
         """
+        self.bookmarks.load()
+        self.worker.start()
         server_address = ('', self.port)
-        httpd = HTTPServer(server_address, ServerHandler)
-        logging.info('Server running on port {}'.format(self.port))
-        httpd.serve_forever()
+        httpd = ThreadingHTTPServer(server_address, ServerHandler)
+        httpd.bookmarks = self.bookmarks
+        httpd.worker = self.worker
+        logging.info('Server running on port %s', self.port)
+        # `bookmarks server stop` sends SIGTERM, handle it like ctrl-c so the socket and the worker are closed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            logging.info('Server stopping')
+        finally:
+            httpd.server_close()
+            self.worker.stop()
 
 class ServerHandler(BaseHTTPRequestHandler):
+    # keep the connection open between requests, browsers send a search for every keystroke
+    protocol_version = 'HTTP/1.1'
+    # buffer the responses, so the headers and body are sent together when the request is done
+    wbufsize = -1
+
+    # names of the request handler methods, by path
+    get_routes = {'/search': 'handle_search'}
+    post_routes = {'/add': 'handle_add', '/search_multi': 'handle_search_multi'}
+
     def do_GET(self):
         """
             Handle GET request from client
         """
-        if self.path.startswith('/search'):
-            self.handle_search()
-            return
-        logging.info('Invalid path')
-        return
+        self.dispatch(self.get_routes)
 
     def do_POST(self):
         """
             Handle POST request from client
         """
         logging.info('POST request')
-        if self.path.startswith('/add'):
-            self.handle_add()
-            return
-
-        return
+        self.dispatch(self.post_routes)
 
     def do_OPTIONS(self):
         """
             Handle OPTION request from client
         """
         logging.info('OPTION request')
-        if self.path.startswith('/add'):
+        if self.path.partition('?')[0] in self.post_routes:
             self.send_response(200)
+            self.send_header('Content-Length', '0')
             self.send_cors_headers()
             self.end_headers()
             return
 
-        return
+        self.send_error(404)
+
+    def dispatch(self, routes):
+        """
+            Call the handler of the request path, the query string is kept for parse_get_params
+        """
+        path, _, self.query = self.path.partition('?')
+        handler = routes.get(path)
+        if handler is None:
+            logging.info('Invalid path')
+            self.send_error(404)
+            return
+        getattr(self, handler)()
 
     def handle_search(self):
         """
             Handle search request from client
         """
-        self.parse_params()
+        if not self.parse_params():
+            return
         search_value = self.get_params.get('q', '')
         format = self.get_params.get('format', 'html')
-        logging.info('Searching for {}'.format(search_value))
+        limit = self.get_params.get('limit', '')
+        limit = int(limit) if limit.isdecimal() else SEARCH_LIMIT
+        limit = max(1, min(limit, SEARCH_LIMIT))
+        logging.info('Searching for %s', search_value)
+
+        # the json output is cached already encoded, no need to encode the results again
+        if format == 'json':
+            result = self.server.bookmarks.search_json(search_value, limit)
+            logging.debug('Result: %s', result)
+            self.output_result(None, format, raw_json=result)
+            return
 
-        # search all the files in the directory tree using commandline
-        command_dir = os.path.dirname(os.path.realpath(__file__))
-        command = [command_dir + '/bookmarks', 'suggest', search_value]
-        logging.info('Executing command: {}'.format(command))
-        result = subprocess.check_output(command)
+        result = self.server.bookmarks.search(search_value, limit)
 
-        logging.debug('Result: {}'.format(result))
-        # convert response text to json
-        result = json.loads(result)
+        logging.debug('Result: %s', result)
         self.output_result(result, format)
 
+    def handle_search_multi(self):
+        """
+            Handle a batch of search requests from client, returns the results of each query
+        """
+        if not self.parse_params():
+            return
+        queries = self.post_params.get('queries')
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            self.send_error(400, 'Expected a list of queries')
+            return
+        if len(queries) > MAX_BATCH_SIZE:
+            self.send_error(400, 'Too many queries')
+            return
+        logging.info('Searching for %s', queries)
+
+        # search the shorter queries first, so the longer ones only filter their cached candidates
+        result = {}
+        for query in sorted(set(queries), key=len):
+            result[query] = self.server.bookmarks.search(query)
+        self.output_result(result, 'json')
+
     def handle_add(self):
         """
             Handle add request from client
         """
-        self.parse_params()
+        if not self.parse_params():
+            return
         url = self.post_params.get('url', '')
         title = self.post_params.get('title', '')
         category = self.post_params.get('category', '')
-        logging.info('Adding {} {} {}'.format(url, title, category))
-
-        # add a new bookmark using commandline
-        command_dir = os.path.dirname(os.path.realpath(__file__))
-        command = [command_dir + '/bookmarks', 'add', '--uri', url, '--title', title, '--category', category]
-        logging.info('Executing command: {}'.format(command))
-        # run the command in a subprocess and get the exit code
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        proc.wait()
-        (stdout, stderr) = proc.communicate()
-
-        if proc.returncode != 0:
+        logging.info('Adding %s %s %s', url, title, category)
+        # the title and category may be empty, the bookmarks script fetches the page title
+        # and picks a default category
+        if not (isinstance(url, str) and url and isinstance(title, str) and isinstance(category, str)):
+            self.send_error(400, 'Expected a url, title and category')
+            return
+        if any('\0' in value for value in (url, title, category)):
+            self.send_error(400, 'Invalid bookmark')
+            return
+        if self.post_form:
+            # the bookmarks script url decodes the values itself, so send them encoded again
+            url, title, category = (quote(value, safe='') for value in (url, title, category))
+
+        # add a new bookmark using the bookmarks worker
+        exit_code, output = self.server.worker.call('add', '--uri', url, '--title', title, '--category', category)
+
+        if exit_code != 0:
             # if the exit code is not 0, then there was an error
             logging.error('Error adding url')
-            # convert error message to json
-            stderr = stderr.decode('utf-8')
-            # split the error message into lines
-            stderr = stderr.split('\n')
-            # remove empty lines
-            stderr = [line for line in stderr if line]
-            self.output_result({'error': 'Error adding url', 'message': stderr}, 'json')
+            self.output_result({'error': 'Error adding url', 'message': output}, 'json')
             return
 
+        self.server.bookmarks.invalidate()
         self.output_result({'success': 'Url added'}, 'json')
 
+    def log_message(self, format, *args):
+        """
+            Write the access log to the server log instead of stderr
+        """
+        logging.debug(format, *args)
+
+    def log_error(self, format, *args):
+        """
+            Write the request errors to the server log instead of stderr. These are the client
+            errors sent with send_error, like the favicon 404 of every html page, so they are info
+        """
+        logging.info(format, *args)
+
     def send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS, PUT, DELETE')
@@ -140,78 +647,120 @@ class ServerHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Max-Age', '86400')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Requested-With')
 
-    def output_result(self, result, format):
+    def output_result(self, result, format, raw_json=None):
         """
-            Output the result to the client
+            Output the result to the client, raw_json is the result already encoded as JSON
         """
-        logging.info('Output format: {}'.format(format))
+        logging.info('Output format: %s', format)
         if format == 'json':
-            # Send the result back to the client
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_cors_headers()
-            self.end_headers()
             # output json string
-            self.wfile.write(bytes(json.dumps(result), 'utf-8'))
+            body = raw_json if raw_json is not None else json_dumps(result)
+            self.send_body(body, 'application/json', cors=True)
             return
 
         if format == 'text':
-            # Send the result back to the client
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
             # convert json to text
-            result = '\n'.join([obj.get('url') for obj in result])
-            self.wfile.write(bytes(str(result), 'utf-8'))
-
+            body = '\n'.join([obj['url'] for obj in result]).encode('utf-8')
+            self.send_body(body, 'text/plain')
             return
+
         if format == 'html':
             # transform a list of uris to a html list of anchor tags
-            result = ['<li><a href="{}">{}</a></li>'.format(o.get('title'), o.get('url')) for o in result]
-            result = ''.join(result)
-            result = '<ul>' + result + '</ul>'
-            result = PAGE_TEMPLATE.format(result)
-            # Send the result back to the client
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(bytes(result, 'utf-8'))
+            # escape the bookmark fields, titles come from the bookmarked pages
+            items = ''.join([ITEM_TEMPLATE % (escape(o['url']), escape(o['title'])) for o in result])
+            body = PAGE_PREFIX + f'<ul>{items}</ul>'.encode('utf-8') + PAGE_SUFFIX
+            self.send_body(body, 'text/html')
+            return
+
+        self.send_error(400, 'Unknown format')
+
+    def send_body(self, body, content_type, cors=False):
+        """
+            Send the response body to the client. GET responses carry an ETag,
+            so a client repeating the same search gets an empty 304 instead of the body again
+        """
+        etag = None
+        if self.command == 'GET':
+            etag = '"%x"' % zlib.crc32(body)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                if cors:
+                    self.send_cors_headers()
+                self.end_headers()
+                return
+
+        # Send the result back to the client
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if cors:
+            self.send_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
 
     def parse_params(self):
         """
-            Parse the GET and POST parameters from the request
+            Parse the GET and POST parameters from the request,
+            returns False if the request was already answered with an error
         """
         self.parse_get_params()
-        self.parse_post_params()
+        return self.parse_post_params()
 
     def parse_get_params(self):
         """
             Parse the GET parameters from the URL
         """
         # Parse the GET parameters
-        self.get_params = {}
-        if '?' in self.path:
-            self.get_params = dict([p.split('=') for p in self.path.split('?')[1].split('&')])
+        self.get_params = dict(parse_qsl(self.query))
 
-        logging.info('GET path: {}'.format(self.path))
-        logging.info('GET params: {}'.format(self.get_params))
+        logging.info('GET path: %s', self.path)
+        logging.info('GET params: %s', self.get_params)
 
     def parse_post_params(self):
         """
-            Parse the POST parameters from the request body
+            Parse the POST parameters from the request body,
+            returns False if the body is too large and the request was answered with 413
         """
-        # Parse the POST parameters
+        # Parse the POST parameters, a malformed body leaves them empty
         self.post_params = {}
-        if self.headers.get('Content-Length'):
-            content_length = int(self.headers.get('Content-Length'))
+        self.post_form = False
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            # the body can not be skipped without its length, it would be taken for the next request
+            logging.warning('Invalid Content-Length: %s', self.headers.get('Content-Length'))
+            self.close_connection = True
+            return True
+        if content_length == 0:
+            return True
+        if content_length > MAX_BODY_SIZE:
+            # send_error drops the connection, the unread body is not taken for the next request
+            logging.warning('POST body of %s bytes is too large', content_length)
+            self.send_error(413)
+            return False
 
-            body = self.rfile.read(content_length)
-            # parse json body
-            if self.headers.get('Content-Type') == 'application/json':
-                self.post_params = json.loads(body.decode('utf-8'))
-            else:
-                # parse url encoded body
-                self.post_params = dict([p.split('=') for p in body.decode('utf-8').split('&')])
+        body = self.rfile.read(content_length)
+        content_type = self.headers.get('Content-Type', '').partition(';')[0].strip()
+        # parse json body
+        if content_type == 'application/json':
+            try:
+                params = json_loads(body)
+            except ValueError:
+                logging.warning('Invalid JSON body')
+                return True
+            if isinstance(params, dict):
+                self.post_params = params
+        else:
+            # parse url encoded body
+            self.post_params = dict(parse_qsl(body.decode('utf-8', 'replace')))
+            self.post_form = True
+        return True
 
     def search_files(self, search_value):
         """
@@ -221,6 +770,6 @@ class ServerHandler(BaseHTTPRequestHandler):
 
 # Get the port from the first commandline argument, and default to 8000 if missing
 port = int(os.sys.argv[1]) if len(os.sys.argv) > 1 else 8000
-server = Server(port)
+server = Server(port, BOOKMARKS_DIR)
 server.run()
 